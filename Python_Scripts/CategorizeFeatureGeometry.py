@@ -14,13 +14,24 @@ Version: 3.0
 
 
 import arcpy
-import datetime
+import re
 import string
+import uuid
 
 
 class CategorizeFeatureGeometry(object):
     
 
+    _FIELD_NAME_PUNCTUATION = re.compile(
+        '[{}]'.format(re.escape(string.punctuation.replace('_', ''))))
+
+    # Target x division feature count above which an 'in_memory' job is
+    # moved to the scratch geodatabase.  This is only a rough proxy: after
+    # the single overlay, memory use grows with the size of the output, not
+    # with the product of the input counts.
+    _IN_MEMORY_FEATURE_LIMIT = 100000000
+
+
     def __init__(self, target_features, division_features, division_field,
                  output_features, output_field, overrun=False,
                  include_uncategorized=False, workspace='in_memory'):
@@ -60,7 +71,9 @@ class CategorizeFeatureGeometry(object):
                                             (a provided path will allow
                                             processing for a larger dataset
                                             that would otherwise overwhelm the
-                                            'in_memory' environment)
+                                            'in_memory' environment; large
+                                            'in_memory' jobs are moved to the
+                                            scratch geodatabase)
         -----------------------------------------------------------------------       
         """
 
@@ -72,45 +85,51 @@ class CategorizeFeatureGeometry(object):
         self.output_field = output_field
         self.overrun = overrun
         self.include_uncategorized = include_uncategorized
-        self.workspace = workspace
+        self.workspace = self.__select_workspace(workspace)
 
         self.__set_geoprocessing_workspace(self.workspace)
 
-        self.timestamp = self.__create_timestamp()
-        self.attribute_set = self.__get_unique_attributes()
-        self.parameter_dictionary = self.__create_parameter_dictionary()
-        
+        self.run_id = self.__create_run_id()
+        self.category_field = 'tmp{}'.format(self.run_id[:7])
+
         self.division_field_properties = self.__get_division_field_properties()
         self.__validate_output_field_name()
         self.output_field_properties = self.__set_output_field_properties()
 
-        self.__validate_criteria()
-
         self.target_layer = self.__create_target_layer()
-        self.__add_category_field()
+        self.division_layer = self.__create_division_layer()
         self.__categorize_target_layer()
 
         self.__delete_intermediary_data()
 
 
-    def __get_unique_attributes(self):
-        
-        arcpy.AddMessage('Scanning categories...')
-        return set(target_row.getValue(self.division_field)
-                   for target_row in arcpy.SearchCursor(
-                       self.division_features))
-
-
     def __get_division_field_properties(self):
         
-        division_fields = arcpy.ListFields(self.division_features)
-        for field in division_fields:
-            if field.name == self.division_field:
-                return {'field_name':      field.name,
-                        'field_type':      field.type,
-                        'field_length':    field.length,
-                        'field_precision': field.precision,
-                        'field_scale':     field.scale}
+        field = next((field for field in
+                      arcpy.ListFields(self.division_features)
+                      if field.name == self.division_field), None)
+        if field is None:
+            raise ValueError('Field {} not found in {}'.format(
+                self.division_field, self.division_features))
+        return {'field_name':      field.name,
+                'field_type':      field.type,
+                'field_length':    field.length,
+                'field_precision': field.precision,
+                'field_scale':     field.scale}
+
+
+    def __select_workspace(self, workspace):
+        
+        if workspace != 'in_memory':
+            return workspace
+        target_count, division_count = [
+            int(arcpy.GetCount_management(features).getOutput(0))
+            for features in (self.target_features, self.division_features)]
+        if target_count * division_count > self._IN_MEMORY_FEATURE_LIMIT:
+            arcpy.AddMessage(
+                'Dataset too large for in_memory; using scratch workspace...')
+            return arcpy.env.scratchGDB
+        return workspace
 
 
     def __set_geoprocessing_workspace(self, path):
@@ -120,64 +139,82 @@ class CategorizeFeatureGeometry(object):
     def __set_output_field_properties(self):
         
         field_properties = {
-            i: self.division_field_properties[i]
-            if self.division_field_properties[i] != 0 else None
-            for i in self.division_field_properties}
-        key_removal_list = list()
-        for key in field_properties:
-            if not field_properties[key]:
-                key_removal_list.append(key)
-        for key in key_removal_list:
-            field_properties.pop(key)
+            key: value for key, value in
+            self.division_field_properties.items() if value}
         field_properties['field_type'] = field_properties['field_type'].upper()
         field_properties['field_name'] = self.output_field
         return field_properties
 
 
-    def __create_timestamp(self):
+    def __create_run_id(self):
         
-        return str(hex(int(datetime.datetime.utcnow().strftime(
-            '%Y%m%d%H%M%S'))).rstrip('L').lstrip('0x'))
+        return uuid.uuid4().hex[:12]
 
 
-    def __create_parameter_dictionary(self):
+    def __create_target_layer(self):
         
-        return {i:{'category': list(self.attribute_set)[i],
-                   'category_file': 'tmp_cat_{}_{}'.format(i, self.timestamp),
-                   'division_file': 'tmp_div_{}_{}'.format(i, self.timestamp),
-                   'criteria': list(self.attribute_set)[i]}
-                for i in range(0, len(self.attribute_set))}
+        target_layer = 'tmp_lyr_{}'.format(self.run_id)
+        arcpy.MakeFeatureLayer_management(
+            in_features=self.target_features,
+            out_layer=target_layer)                  
+        return target_layer
 
 
-    def __validate_criteria(self):
+    def __create_division_layer(self):
         
-        if self.output_field_properties['field_type'] == 'STRING':
-            for key in self.parameter_dictionary:
-                self.parameter_dictionary[key][
-                    'criteria'] = self.parameter_dictionary[key][
-                        'criteria'].replace('\'', '\'\'')
-                self.parameter_dictionary[key][
-                    'criteria'] = '\'' + self.parameter_dictionary[key][
-                        'criteria'] + '\''
+        division_layer = 'tmp_div_lyr_{}'.format(self.run_id)
+        field_info = ';'.join(
+            '{} {} VISIBLE NONE'.format(field.name, self.category_field)
+            if field.name == self.division_field else
+            '{0} {0} {1} NONE'.format(
+                field.name, 'VISIBLE' if field.type in ('Geometry', 'OID')
+                else 'HIDDEN')
+            for field in arcpy.ListFields(self.division_features))
+        arcpy.MakeFeatureLayer_management(
+            in_features=self.division_features,
+            out_layer=division_layer,
+            where_clause='{} IS NOT NULL'.format(
+                arcpy.AddFieldDelimiters(self.division_features,
+                                         self.division_field)),
+            field_info=field_info)
+        return division_layer
 
 
-    def __create_target_layer(self):
+    def __transfer_category_field(self, dataset):
         
-        replicated_target_features = 'tmp_rep_{}'.format(self.timestamp)
-        target_layer = 'tmp_lyr_{}'.format(self.timestamp)
-        arcpy.CopyFeatures_management(
-            in_features=self.target_features,
-            out_feature_class=replicated_target_features)
-        arcpy.MakeFeatureLayer_management(
-            in_features=replicated_target_features,
-            out_layer=target_layer)                  
-        return target_layer
+        arcpy.AddField_management(in_table=dataset,
+                                  **self.output_field_properties)
+        with arcpy.da.UpdateCursor(
+            in_table=dataset,
+            field_names=[self.category_field, self.output_field]) as cursor:
+            for row in cursor:
+                row[1] = row[0]
+                cursor.updateRow(row)
+        arcpy.DeleteField_management(in_table=dataset,
+                                     drop_field=self.category_field)
 
 
-    def __add_category_field(self):
+    def __transfer_joined_categories(self, dataset):
         
-        arcpy.AddField_management(in_table=self.target_layer,
+        arcpy.AddField_management(in_table=dataset,
                                   **self.output_field_properties)
+        processed_joins = set()
+        with arcpy.da.UpdateCursor(
+            in_table=dataset,
+            field_names=['TARGET_FID', self.category_field,
+                         self.output_field]) as cursor:
+            for row in cursor:
+                join_key = (row[0], row[1])
+                if join_key in processed_joins:
+                    cursor.deleteRow()
+                else:
+                    processed_joins.add(join_key)
+                    row[2] = row[1]
+                    cursor.updateRow(row)
+        arcpy.DeleteField_management(
+            in_table=dataset,
+            drop_field=[self.category_field, 'Join_Count', 'TARGET_FID',
+                        'JOIN_FID'])
 
 
     def __delete_intermediary_data(self):
@@ -185,7 +222,7 @@ class CategorizeFeatureGeometry(object):
         if self.workspace != 'in_memory':
             delete_list = [
                 delete_file for delete_file in
-                arcpy.ListFeatureClasses('tmp_*{}*'.format(self.timestamp))]
+                arcpy.ListFeatureClasses('tmp_*{}*'.format(self.run_id))]
             for delete_file in delete_list:
                 arcpy.Delete_management(delete_file)
         else:
@@ -194,8 +231,8 @@ class CategorizeFeatureGeometry(object):
 
     def __validate_output_field_name(self):
 
-        for i in string.punctuation.replace('_',''):
-            self.output_field = self.output_field.replace(i, '')
+        self.output_field = self._FIELD_NAME_PUNCTUATION.sub(
+            '', self.output_field)
 
         if self.output_field[0].isdigit():
             self.output_field = 'Field_{}'.format(self.output_field)
@@ -213,68 +250,31 @@ class CategorizeFeatureGeometry(object):
     def __categorize_target_layer(self):
         
         arcpy.AddMessage('Categorizing target features...')
-        temporary_output = 'tmp_out_{}'.format(self.timestamp)
-        
-        for key in self.parameter_dictionary:
-            arcpy.AddMessage('Processing category {} of {}...'.format(
-                key+1, len(self.parameter_dictionary)))
-            arcpy.Select_analysis(
-                in_features = self.division_features,
-                out_feature_class = self.parameter_dictionary[key][
-                    'division_file'],
-                where_clause = '{} = {}'.format(
-                    arcpy.AddFieldDelimiters(self.division_features,
-                                             self.division_field),
-                    self.parameter_dictionary[key]['criteria']))
-
-            if not self.overrun:
-                arcpy.Clip_analysis(
-                    in_features=self.target_layer,
-                    clip_features=self.parameter_dictionary[key][
-                        'division_file'],
-                    out_feature_class=self.parameter_dictionary[key][
-                        'category_file'])
-            else:
-                arcpy.SelectLayerByLocation_management(
-                    in_layer=self.target_layer,
-                    overlap_type='INTERSECT',
-                    select_features=self.parameter_dictionary[key][
-                        'division_file'])
-                temporary_select_layer = 'tmp_sel_lyr_{}'.format(
-                    self.timestamp)
-                arcpy.MakeFeatureLayer_management(
-                    in_features=self.target_layer,
-                    out_layer=temporary_select_layer)
-                arcpy.CopyFeatures_management(
-                    in_features=temporary_select_layer,
-                    out_feature_class=self.parameter_dictionary[key][
-                        'category_file'])
-                arcpy.Delete_management(in_data=temporary_select_layer)
-
-            arcpy.CalculateField_management(
-                in_table=self.parameter_dictionary[key]['category_file'],
-                field=self.output_field_properties['field_name'],
-                expression='{}{}{}'.format(
-                    'r"', self.parameter_dictionary[key]['category'], '"'),
-                expression_type='PYTHON_9.3')
-
-            if not arcpy.Exists(temporary_output):
-                arcpy.CopyFeatures_management(
-                    in_features=self.parameter_dictionary[key][
-                        'category_file'],
-                    out_feature_class=temporary_output)
-            else:
-                arcpy.Append_management(
-                    inputs=self.parameter_dictionary[key][
-                        'category_file'],
-                    target=temporary_output)
+        temporary_output = 'tmp_out_{}'.format(self.run_id)
+
+        if self.overrun:
+            arcpy.SpatialJoin_analysis(
+                target_features=self.target_layer,
+                join_features=self.division_layer,
+                out_feature_class=self.output_features,
+                join_operation='JOIN_ONE_TO_MANY',
+                join_type=('KEEP_ALL' if self.include_uncategorized
+                           else 'KEEP_COMMON'),
+                match_option='INTERSECT')
+
+            arcpy.AddMessage('Deduplicating data...')
+            self.__transfer_joined_categories(self.output_features)
+            return
+
+        arcpy.Intersect_analysis(
+            in_features=[self.target_layer, self.division_layer],
+            out_feature_class=temporary_output,
+            join_attributes='NO_FID')
+        self.__transfer_category_field(temporary_output)
 
         if self.include_uncategorized:
             arcpy.AddMessage('Processing uncategorized features...')
-            uncategorized_features = 'tmp_unc_fea_{}'.format(self.timestamp)
-            arcpy.SelectLayerByAttribute_management(
-                in_layer_or_view=self.target_layer,
-                selection_type='CLEAR_SELECTION')
+            uncategorized_features = 'tmp_unc_fea_{}'.format(self.run_id)
             arcpy.Erase_analysis(
                 in_features=self.target_layer,
                 erase_features=temporary_output,
@@ -288,22 +288,14 @@ class CategorizeFeatureGeometry(object):
         
         ignore_field_types = ('Geometry', 'GlobalID', 'GUID', 'OID')
 
-        deduplicated_output= 'tmp_ded_{}'.format(self.timestamp)
-        deduplication_fields = {
-            field.name if field.type not in ignore_field_types else None
-            for field in arcpy.ListFields(temporary_output)}
-        deduplication_fields.remove(None)
-        deduplication_fields = list(deduplication_fields)
+        deduplication_fields = [
+            field.name for field in arcpy.ListFields(temporary_output)
+            if field.type not in ignore_field_types]
         arcpy.Dissolve_management(
             in_features=temporary_output,
-            out_feature_class=deduplicated_output,
+            out_feature_class=self.output_features,
             dissolve_field=deduplication_fields)
 
-        arcpy.AddMessage('Generating output features...')
-        arcpy.CopyFeatures_management(
-            in_features=deduplicated_output,
-            out_feature_class=self.output_features)
-
 
 if __name__ == '__main__':
 